@@ -0,0 +1,21 @@
+#!python
+
+"""
+Compiles the doc tool with mypyc, turning its hot loops into a C extension.
+
+Usage:
+    pip install mypy
+    python build.py build_ext --inplace
+
+`main.py` picks up the resulting extension automatically, and keeps running
+as plain Python when it hasn't been built.
+"""
+
+from setuptools import setup
+from mypyc.build import mypycify
+
+setup(
+    name='doccer',
+    py_modules=[],
+    ext_modules=mypycify(['main.py']),
+)
@@ -12,14 +12,19 @@ import os
 import glob
 import ruamel.yaml
 import collections
+import pickle
+import re
 
-from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List
+from functools import lru_cache, partial
+from hashlib import blake2b
+from importlib import import_module, metadata
+from io import StringIO
+from typing import Any, Dict, List, Optional, Tuple, Union
 from os.path import join, dirname
-from ast import parse, NodeVisitor, get_docstring, Name, Call, Module, FunctionDef, ClassDef, Constant
-from docstring_parser import parse as docstring_parse
-from string import Template
+from ast import parse, get_docstring, Attribute, Name, Call, Module, FunctionDef, ClassDef, Constant
+from docstring_parser import Docstring, DocstringParam, DocstringStyle, ParseError, parse as docstring_parse
 
 USAGE = """
 =====================================
@@ -30,84 +35,148 @@ Usage:
     doccer <source path> <markdown path>
 """
 
+PARAM_HEADER = "**Parameters:**\n\n| Name | Type | Description | Default |\n| --- | --- | --- | --- |\n"
+METHOD_HEADER = "\n**Methods:**\n\n| Name | Description | Returns |\n| --- | --- | --- |\n"
+NONE_RETURN = "`None`"
+REQUIRED_DEFAULT = "*is required*"
+
+# Since 3.13 `ast.parse` can fold constants in C before building the Python tree.
+parse_options: Dict[str, Any] = {'optimize': 2} if sys.version_info >= (3, 13) else {}
+
+# Compiled markdown is cached per source file; delete the directory to invalidate.
+# Bump the magic whenever the generated markdown changes shape.
+cache_dir = Path('.doccer-cache')
+cache_magic = b'DOCCER\x07\n'
+
+# The cached markdown also depends on the interpreter (see `parse_options`) and the
+# doc-string parser, so both are part of every cache key.
+try:
+    docstring_parser_version = metadata.version('docstring_parser')
+except metadata.PackageNotFoundError:
+    docstring_parser_version = 'unknown'
+
+cache_environment = f'{sys.version_info[0]}.{sys.version_info[1]}:{docstring_parser_version}'
+
 endpoint_decorators = [
     "get",
     "post",
     "put",
 ]
 
-class_template = Template("""\
-# `class` $name
-$description
-$method_table
+endpoint_verbs = frozenset(endpoint_decorators)
+
+nav_key = re.compile(r'^nav\s*:')
+top_level_key = re.compile(r'^[^\s#-]')
 
----
-""")
+# Start of a function or class statement, see `handle_docs`.
+definition_marker = re.compile(r'^[ \t]*(?:async[ \t]+)?(?:def|class)\b', re.MULTILINE)
 
-function_template = Template("""\
-## `$name($params)`
-$description
+# Section markers telling doc-string styles apart, see `docstring_style`.
+numpydoc_marker = re.compile(r'^\s*-{3,}\s*$', re.MULTILINE)
+google_marker = re.compile(
+    r'^\s*(Args|Arguments|Parameters|Params|Returns|Yields|Raises|Exceptions|Attributes):\s*$',
+    re.MULTILINE
+)
 
-$table_of_params
-""")
+def docstring_style(text: str) -> DocstringStyle:
+    """Guess the style of a doc-string from its section markers.
 
-def param_table_from(params):
+    Parsing with an explicit style runs a single parser, where auto-detection
+    runs every parser and keeps the result with the most meta-data.
+
+    Parameters
+    ----------
+    text : str
+        The doc-string to inspect.
+
+    Returns
+    -------
+    DocstringStyle
+        The style to parse the doc-string with.
+    """
+    if numpydoc_marker.search(text):
+        return DocstringStyle.NUMPYDOC
+    if google_marker.search(text):
+        return DocstringStyle.GOOGLE
+    if '@param' in text or '@return' in text:
+        return DocstringStyle.EPYDOC
+
+    # Auto-detection settles on reST for anything without sections too.
+    return DocstringStyle.REST
+
+# Boilerplate doc-strings repeat a lot across a project, so parse each text once.
+# The parsed objects are shared between callers and must be treated as read-only.
+@lru_cache(maxsize=None)
+def parse_docstring(text: str) -> Docstring:
+    try:
+        return docstring_parse(text, style=docstring_style(text))
+    except ParseError:
+        return docstring_parse(text)
+
+def render_class(name: str, description: str, method_table: str) -> str:
+    return f"# `class` {name}\n{description}\n{method_table}\n\n---\n"
+
+def render_function(name: str, params: str, description: Optional[str], table_of_params: str) -> str:
+    return f"## `{name}({params})`\n{description}\n\n{table_of_params}\n"
+
+def param_table_from(params: List[DocstringParam]) -> str:
     if len(params) == 0:
         return ''
 
-    table = "**Parameters:**\n\n| Name | Type | Description | Default |\n| --- | --- | --- | --- |\n"
+    rows = [PARAM_HEADER]
 
     for p in params:
-        table += f"| {p.arg_name} | {p.type_name} | {p.description} | {p.default or '*is required*'} |\n"
+        rows.append(f"| {p.arg_name} | {p.type_name} | {p.description} | {p.default or REQUIRED_DEFAULT} |\n")
 
-    return table
+    return ''.join(rows)
+
+def method_returns(doc: Docstring) -> str:
+    return NONE_RETURN if doc.returns is None else f'`{doc.returns.type_name}`'
+
+def function_to_markdown(name: str, doc: Optional[Docstring]) -> str:
+    if doc is None:
+        return render_function(name, '', '', '')
 
-def function_to_markdown(name, doc):
     params = ', '.join([f'{n.arg_name}: {n.type_name}' for n in doc.params])
-    return function_template.substitute(
-        name=name,
-        params=params,
-        description=doc.short_description,
-        table_of_params=param_table_from(doc.params)
-    )
-
-def decorator_names(node):
-    def grab_id(n):
-        if isinstance(name.func, Name):
-            return name.func.id
-        else:
-            return name.func.attr
+    return render_function(name, params, doc.short_description, param_table_from(doc.params))
+
+def decorator_id(call: Call) -> str:
+    func = call.func
+
+    if isinstance(func, Name):
+        return func.id
+    if isinstance(func, Attribute):
+        return func.attr
 
+    return ''
+
+def decorator_names(node: Union[FunctionDef, ClassDef]) -> List[str]:
     names = []
-    for name in node.decorator_list:
-        if isinstance(name, Name):
-            names.append(name.id)
-        elif isinstance(name, Call):
-            args = []
-            n = grab_id(name)
-            for arg in name.args:
-                if isinstance(arg, Constant):
-                    args.append(arg.value)
-
-            names.append(n + ':' + ', '.join(args))
+    for decorator in node.decorator_list:
+        if isinstance(decorator, Name):
+            names.append(decorator.id)
+        elif isinstance(decorator, Call):
+            args = [arg.value for arg in decorator.args if isinstance(arg, Constant) and isinstance(arg.value, str)]
+            names.append(f'{decorator_id(decorator)}:{", ".join(args)}')
 
     return names
 
 
-@dataclass
 class ClassDoc(object):
-    """A dataclass for containing class-meta.
+    """A class for containing class-meta.
     """
-    def __init__(self, name, doc, decorators):
+    __slots__ = ('name', 'doc', 'methods', 'decorators')
+
+    def __init__(self, name: str, doc: Optional[Docstring], decorators: List[str]):
         self.name = name
         self.doc = doc
-        self.methods = dict()
+        self.methods: Dict[str, Optional[Docstring]] = dict()
         self.decorators = decorators
 
-    def append_method(self, name: str, doc):
+    def append_method(self, name: str, doc: Optional[Docstring]):
         self.methods[name] = doc
 
-    def __str__(self):
+    def __str__(self) -> str:
         """Generate markdown documentation from class meta-data.
 
         Returns
@@ -115,44 +184,31 @@ class ClassDoc(object):
         str
             The markdown source generated on class template.
         """
-        desc = self.doc.short_description
-        desc = desc == "None" and ' ' or desc
+        desc = self.doc is not None and self.doc.short_description or ' '
         
-        if len(self.methods) != 0:
-            method_table = '\n**Methods:**\n\n| Name | Description | Returns |\n| --- | --- | --- |\n'
-            
-            for name, doc in self.methods.items():
-                if name == '__init__':
-                    continue
-
-                returns = doc.returns is None and '`None`' or f'`{doc.returns.type_name}`'
-                method_table += f'| `{name}` | {doc.short_description} | {returns} |\n'
-
-        else:
-            method_table = ''
+        documented = [(name, doc) for name, doc in self.methods.items() if doc is not None]
+        listed = [(name, doc) for name, doc in documented if name != '__init__']
 
-        base = class_template.substitute(
-            name=self.name,
-            description=desc,
-            method_table=method_table
-        )
+        method_table = METHOD_HEADER + ''.join(
+            f'| `{name}` | {doc.short_description} | {method_returns(doc)} |\n' for name, doc in listed
+        ) if listed else ''
 
-        for name, doc in self.methods.items():
-            if doc.short_description != 'None':
-                base += '\n' + function_to_markdown(name, doc)
+        parts = [render_class(self.name, desc, method_table)]
+        parts.extend(function_to_markdown(name, doc) for name, doc in documented)
 
-        return base
+        return '\n'.join(parts)
 
-@dataclass
 class Doc(object):
+    __slots__ = ('name', 'module', 'classes', 'functions', 'endpoints')
+
     def __init__(self, name: str):
         self.name = name
-        self.module: str = ""
-        self.classes: List[ClassDoc] = list() 
-        self.functions: Dict[str, dict] = dict()
+        self.module: Optional[Docstring] = None
+        self.classes: List[ClassDoc] = list()
+        self.functions: Dict[str, Optional[Docstring]] = dict()
         self.endpoints: Dict[str, str] = dict()
 
-    def append_class(self, name, doc, decorators):
+    def append_class(self, name: str, doc: Optional[Docstring], decorators: List[str]) -> ClassDoc:
         new_class = ClassDoc(name, doc, decorators)
 
         self.classes.append(
@@ -161,56 +217,62 @@ class Doc(object):
 
         return new_class
 
-    def append_function(self, name, doc, decorators):
+    def append_function(self, name: str, doc: Optional[Docstring], decorators: List[str]):
         for decorator in decorators:
-            for point in endpoint_decorators:
-                if point in decorator:
-                    self.endpoints[name] = decorator
+            if decorator.split(':', 1)[0] in endpoint_verbs:
+                self.endpoints[name] = decorator
+                break
 
         self.functions[name] = doc
 
-    def compile(self):
-        class_docs = []
-        func_docs = []
-        endpoint_docs = []
+    def compile(self) -> Tuple[List[str], List[str], List[Tuple[str, str, str]]]:
+        class_docs: List[str] = []
+        func_docs: List[str] = []
+        endpoint_docs: List[Tuple[str, str, str]] = []
 
         for class_ in self.classes:
             class_docs.append(str(class_))
 
         for name, docs in self.functions.items():
-            doc = function_to_markdown(name, docs)
-                
-            if name in self.endpoints.keys():
-                endpoint_docs.append((name, doc, self.endpoints[name]))
-            else:
-                func_docs.append(doc)
+            if name in self.endpoints:
+                endpoint_docs.append((name, function_to_markdown(name, docs), self.endpoints[name]))
+            elif docs is not None:
+                func_docs.append(function_to_markdown(name, docs))
 
         return class_docs, func_docs, endpoint_docs
 
-class DocVisitor(NodeVisitor):
-    def __init__(self, filename):
+class DocVisitor(object):
+    def __init__(self, filename: str):
         self.doc = Doc(filename)
 
-    def visit_Module(self, node: Module):
-        self.doc.module = self.grab_doc(node)
-        self.generic_visit(node)
+    def visit(self, node: Module):
+        """Collect docs from the module, its top-level functions and classes.
+
+        Only the module body and class bodies are walked; anything nested
+        deeper is not documented, so there is no need to descend into it.
 
-    def visit_FunctionDef(self, node: FunctionDef):
-        self.doc.append_function(node.name, self.grab_doc(node), decorator_names(node))
-        self.generic_visit(node)
+        Parameters
+        ----------
+        node : Module
+            The parsed module to grab doc-strings from.
+        """
+        grab_doc = self.grab_doc
+        doc = self.doc
 
-    def visit_ClassDef(self, node: ClassDef):
-        new_class = self.doc.append_class(node.name, self.grab_doc(node), decorator_names(node))
+        doc.module = grab_doc(node)
 
-        for content in node.body:
-            if isinstance(content, FunctionDef):
-                new_class.append_method(content.name, self.grab_doc(content))
-                self.generic_visit(content)
+        for child in node.body:
+            if isinstance(child, FunctionDef):
+                doc.append_function(child.name, grab_doc(child), decorator_names(child))
+            elif isinstance(child, ClassDef):
+                new_class = doc.append_class(child.name, grab_doc(child), decorator_names(child))
 
-        self.generic_visit(node)
+                for content in child.body:
+                    if isinstance(content, FunctionDef):
+                        new_class.append_method(content.name, grab_doc(content))
 
     @staticmethod
-    def grab_doc(node):
+    def grab_doc(node: Union[Module, FunctionDef, ClassDef]) -> Optional[Docstring]:
         """Grabs the documentation from given AST node.
 
         Parameters
@@ -220,98 +282,275 @@ class DocVisitor(NodeVisitor):
 
         Returns
         -------
-        str
-            The doc-string of the given AST node.
+        Docstring
+            The parsed doc-string of the given AST node, or None if it has none.
 
         """
-        return docstring_parse(get_docstring(node).__str__())
+        docstring = get_docstring(node)
+        return parse_docstring(docstring) if docstring else None
+
+
+def cache_key(path):
+    """Derive the cache key of a source file from its path, mtime and size.
+
+    The interpreter and `docstring_parser` versions are mixed in as well, so an
+    upgrade of either never reuses stale pages.
+
+    Parameters
+    ----------
+    path : str
+        The path of given Python file.
+
+    Returns
+    -------
+    str
+        Hex digest naming the file's entry in the cache directory.
+    """
+    stat = os.stat(path)
+    return blake2b(
+        f'{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}:{cache_environment}'.encode()
+    ).hexdigest()
+
+def load_cached(key):
+    try:
+        with open(cache_dir / key, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    if not data.startswith(cache_magic):
+        return None
+
+    # A corrupt entry is just a cache miss; the file gets parsed again.
+    try:
+        return pickle.loads(data[len(cache_magic):])
+    except (pickle.UnpicklingError, EOFError):
+        return None
+
+def store_cached(key, compiled):
+    # The cache is only an optimisation, so an unwritable cache never fails a run.
+    try:
+        cache_dir.mkdir(exist_ok=True)
+
+        # Write under a unique name first so concurrent workers never see a partial entry.
+        tmp_path = cache_dir / f'{key}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(cache_magic + pickle.dumps(compiled, pickle.HIGHEST_PROTOCOL))
+
+        os.replace(tmp_path, cache_dir / key)
+    except OSError:
+        pass
+
+def iter_sources(root):
+    """Yield the paths of all Python sources below a directory.
+
+    `os.scandir` hands back file types from the directory listing itself,
+    which avoids a `stat` call and a `Path` object per entry.
+
+    Parameters
+    ----------
+    root : str
+        The directory to search through.
+    """
+    stack = [root]
 
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            sub_dirs = []
 
-def handle_docs(path, md_path):
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    sub_dirs.append(entry.path)
+                elif entry.name.endswith('.py') and entry.name != '__init__.py':
+                    yield entry.path
+
+        stack.extend(reversed(sub_dirs))
+
+def write_document(path: str, text: str):
+    """Write a fully rendered document with as few system calls as possible.
+
+    The text is complete up front, so it goes straight to the file descriptor
+    instead of through Python's buffered writer.
+
+    Parameters
+    ----------
+    path : str
+        The path of the markdown document to write.
+    text : str
+        The markdown source of the document.
+    """
+    data = text.encode('utf-8')
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+
+    try:
+        written = os.write(fd, data)
+
+        while written < len(data):
+            written += os.write(fd, data[written:])
+    finally:
+        os.close(fd)
+
+def handle_docs(path: str, md_path: str) -> List[Tuple[str, object]]:
     """Extracts all docstrings from a given Python source file.
 
     Parameters
     ----------
     path : str
         The path of given Python file.
+    md_path : str
+        The directory to write the markdown documents to.
+
+    Returns
+    -------
+    list
+        The `(name, entry)` navigation entries of the written documents, empty
+        when the file has nothing to document.
     """
-    with open(path, 'r', encoding='utf-8') as f:
-        source = f.read()
+    print(f'Extracting docs from {path}!')
 
-    visitor = DocVisitor(path)
-    visitor.visit(parse(source))
+    md_file = Path(path).stem
+    key = cache_key(path)
+    compiled = load_cached(key)
+
+    if compiled is None:
+        with open(path, 'r', encoding='utf-8') as f:
+            source = f.read()
+
+        compiled = [], [], []
+
+        # A plain text scan is far cheaper than building an AST, so files without
+        # any triple-quoted string or `def`/`class` statement are skipped straight
+        # away. Anything else may hold doc-strings or endpoints and gets parsed.
+        if '"""' in source or "'''" in source or definition_marker.search(source):
+            visitor = DocVisitor(path)
+            visitor.visit(parse(source, filename=str(path), mode='exec', **parse_options))
+            compiled = visitor.doc.compile()
+
+        store_cached(key, compiled)
 
-    table_of_contents = dict()
+    # The module doc-string isn't rendered, so a file that compiles to no
+    # sections at all would only produce an empty page; skip it entirely.
+    if not any(compiled):
+        print(f'... No docs found in {md_file}')
+
+        return []
+
+    table_of_contents = []
 
     def section(name, file):
-        table_of_contents[name] = file
+        table_of_contents.append((name, file))
 
-    md_file = Path(path).stem
     section(md_file, md_file + '.md')
 
-    with open(join(md_path, md_file + '.md'), 'w+') as f:
-        classes, funcs, endpoints = visitor.doc.compile()
+    classes, funcs, endpoints = compiled
+    documents = [(join(md_path, md_file + '.md'), '---\n\n'.join(classes) + '---\n\n'.join(funcs))]
 
-        if endpoints != []:
-            endpoint_dir = join(md_path, f'{md_file}_endpoints')
-            os.makedirs(endpoint_dir, exist_ok=True)
+    if endpoints != []:
+        endpoint_dir = join(md_path, f'{md_file}_endpoints')
+        os.makedirs(endpoint_dir, exist_ok=True)
 
-            nav_endpoints = []
+        nav_endpoints = []
 
-            for (name, doc, http) in endpoints:
-                http_ = http.split(':')
-                new_file = Path(http_[1]).stem + '.md'
-                new_path = join(endpoint_dir, new_file)
-                
-                nav_endpoints.append({new_path[:-3].split('/')[-1]: join(f'{md_file}_endpoints', new_file) })
-    
-                with open(new_path, 'w+') as endpoint_f:
-                    endpoint_f.write(f'# {http_[0].upper()} `{http_[1]}/` \n\n' + doc)
+        for (name, doc, http) in endpoints:
+            http_ = http.split(':')
+            new_file = Path(http_[1]).stem + '.md'
+            new_path = join(endpoint_dir, new_file)
 
-            section(f'{md_file} - Endpoints', nav_endpoints)
+            nav_endpoints.append({new_path[:-3].split('/')[-1]: join(f'{md_file}_endpoints', new_file) })
+            documents.append((new_path, f'# {http_[0].upper()} `{http_[1]}/` \n\n' + doc))
 
-        f.write('---\n\n'.join(classes))
-        f.write('---\n\n'.join(funcs))
+        section(f'{md_file} - Endpoints', nav_endpoints)
 
-    print(f'... Wrote docs to {md_file}')
+    for document_path, text in documents:
+        write_document(document_path, text)
 
-    # print(visitor.doc.compile())
+    print(f'... Wrote docs to {md_file}')
 
     return table_of_contents
 
-if __name__ == '__main__':
-    if len(sys.argv) < 4:
+def update_nav(yml_path: str, nav: List[Dict[str, Any]]):
+    """Replace the `nav` section of an MkDocs config with the given entries.
+
+    Only the top-level `nav` block is spliced into the config text, so the
+    rest of the file is never parsed. Comments and tags such as
+    `!!python/name:` stay intact, and the new block is emitted by the safe
+    dumper, which uses libyaml when `ruamel.yaml.clib` is installed.
+
+    Parameters
+    ----------
+    yml_path : str
+        The path of the MkDocs config file.
+    nav : list
+        The navigation entries to write.
+    """
+    with open(yml_path, 'r') as f:
+        lines = f.read().splitlines(keepends=True)
+
+    start = next((i for i, line in enumerate(lines) if nav_key.match(line)), len(lines))
+    end = start + 1
+
+    # The block runs up to the next top-level key. Column-0 comments inside it,
+    # such as commented-out entries, belong to it; trailing blank and comment
+    # lines are left in place as they usually head the next key.
+    while end < len(lines) and not top_level_key.match(lines[end]):
+        end += 1
+    while end > start + 1 and (not lines[end - 1].strip() or lines[end - 1].startswith('#')):
+        end -= 1
+
+    yaml = ruamel.yaml.YAML(typ='safe', pure=False)
+    yaml.default_flow_style = False
+
+    block = StringIO()
+    yaml.dump({'nav': nav}, block)
+
+    head = ''.join(lines[:start])
+    if head and not head.endswith('\n'):
+        head += '\n'
+
+    with open(yml_path, 'w') as f:
+        f.write(head + block.getvalue() + ''.join(lines[end:]))
+
+def run(argv: List[str]):
+    """Generate the markdown documents and MkDocs navigation for a project.
+
+    Parameters
+    ----------
+    argv : list
+        The command line arguments, as in `sys.argv`.
+    """
+    if len(argv) < 4:
         print(USAGE)
         print("[error] Please provide relevant paths!")
 
         sys.exit(1)
     else:
-        py_path = sys.argv[1]
-        md_path = sys.argv[2]
-        yml_path = sys.argv[3]
+        py_path = argv[1]
+        md_path = argv[2]
+        yml_path = argv[3]
 
-        table_of_contents = list()
+        toc_entries = []
 
         if os.path.isfile(py_path):
-            print(f'Extracting docs from {py_path}!')
-            for name, file in handle_docs(py_path, md_path).items():
-                table_of_contents.append({name: file})
+            toc_entries.extend(handle_docs(py_path, md_path))
 
         else:
-            for file in Path(py_path).rglob('*.py'):
-                if file.stem == '__init__':
-                    continue
-
-                print(f'Extracting docs from {file}!')
-                for name, file in handle_docs(file, md_path).items():
-                    table_of_contents.append({name: file})
+            files = list(iter_sources(py_path))
 
-        yaml = ruamel.yaml.YAML()
+            # Every file is parsed and emitted independently, so spread the
+            # CPU-bound work across processes and merge the results after.
+            with ProcessPoolExecutor() as executor:
+                for entries in executor.map(partial(handle_docs, md_path=md_path), files, chunksize=16):
+                    toc_entries.extend(entries)
 
-        with open(yml_path, 'r') as f:
-            data = yaml.load(f)
+        update_nav(yml_path, [{name: entry} for name, entry in toc_entries])
 
-        data["nav"] = table_of_contents 
-
-        with open(yml_path, 'w') as f:
-            yaml.dump(data, f)
+if __name__ == '__main__':
+    # Import ourselves by module name, so the mypyc-compiled extension built by
+    # `build.py` is picked up when it sits next to this file. Without it this
+    # simply loads the pure-Python source, or falls back to the `run` above.
+    try:
+        run_main = import_module(Path(__file__).stem).run
+    except ImportError:
+        run_main = run
+
+    run_main(sys.argv)